@@ -1,8 +1,9 @@
-from nicegui import ui, app
-from io import BytesIO
+from nicegui import ui, app, run
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from io import StringIO
+from tempfile import SpooledTemporaryFile
 import traceback
-import base64
-import matplotlib.pyplot as plt
 import asyncio
 
 # Import the class from the other file
@@ -18,22 +19,98 @@ uploaded_files = {
     "peak_list": None,
     "psm_data": None,
     "psm_name": None,
+    "loaded": False, # Whether the fingerprinter holds the current uploads
 }
 
-def handle_peak_upload(e):
+# PNG bytes of the latest plots, served by /plot/{i}. The version changes on
+# every run so browsers don't show a cached image from a previous analysis.
+plot_pngs = {
+    "images": [],
+    "version": 0,
+}
+
+# Only one analysis may run at a time: all runs share the global fingerprinter
+analysis_lock = asyncio.Lock()
+
+# Uploads larger than this spill from memory to a temporary file on disk
+MAX_IN_MEMORY_UPLOAD = 50_000_000
+
+async def _store_upload(key, file):
+    """Copies an upload into a spooled temporary file, replacing any previous one."""
+    if uploaded_files[key] is not None:
+        uploaded_files[key].close()
+    spooled = SpooledTemporaryFile(max_size=MAX_IN_MEMORY_UPLOAD)
+    async for chunk in file.iterate():
+        spooled.write(chunk)
+    uploaded_files[key] = spooled
+    uploaded_files["loaded"] = False
+
+async def handle_peak_upload(e):
     """Callback for peak list file upload."""
-    uploaded_files["peak_list"] = BytesIO(e.content.read())
-    peak_upload_label.text = f"Uploaded: {e.name}"
-    ui.notify(f"Peak list '{e.name}' uploaded.", color='positive')
+    await _store_upload("peak_list", e.file)
+    peak_upload_label.text = f"Uploaded: {e.file.name}"
+    ui.notify(f"Peak list '{e.file.name}' uploaded.", color='positive')
 
-def handle_psm_upload(e):
+async def handle_psm_upload(e):
     """Callback for PSM data file upload."""
-    uploaded_files["psm_data"] = BytesIO(e.content.read())
-    uploaded_files["psm_name"] = e.name # Store filename to check extension
-    psm_upload_label.text = f"Uploaded: {e.name}"
-    ui.notify(f"PSM data '{e.name}' uploaded.", color='positive')
+    await _store_upload("psm_data", e.file)
+    uploaded_files["psm_name"] = e.file.name # Store filename to check extension
+    psm_upload_label.text = f"Uploaded: {e.file.name}"
+    ui.notify(f"PSM data '{e.file.name}' uploaded.", color='positive')
+
+class LoopLogger:
+    """Forwards log messages to a ui.log on the event loop, from any thread."""
+    def __init__(self, log_element, loop):
+        self.log_element = log_element
+        self.loop = loop
+
+    def push(self, message):
+        # UI elements must only be touched from the event loop thread
+        self.loop.call_soon_threadsafe(self.log_element.push, message)
+
+def build_search_text(display_df):
+    """Joins each row's values into one lower-cased string for the table search."""
+    # Missing cells become '' so one NaN doesn't blank out the whole row's text,
+    # and a newline separator keeps a search term from matching across columns
+    columns = [display_df[col].astype(str).fillna('') for col in display_df.columns]
+    return columns[0].str.cat(columns[1:], sep='\n', na_rep='').str.lower()
+
+def update_table_page(table, display_df, search_text, request):
+    """Serves one page of the (searched and sorted) results to the table."""
+    pagination = request['pagination']
+    df = display_df
+
+    search = request.get('filter')
+    if search:
+        mask = search_text.str.contains(search.lower(), regex=False).to_numpy()
+        df = df[mask]
+
+    if pagination.get('sortBy'):
+        df = df.sort_values(pagination['sortBy'], ascending=not pagination.get('descending'))
+
+    rows_per_page = pagination['rowsPerPage']
+    if rows_per_page: # Quasar uses 0 for "show all rows"
+        start = (pagination['page'] - 1) * rows_per_page
+        df_page = df.iloc[start:start + rows_per_page]
+    else:
+        df_page = df
+
+    table.rows = df_page.to_dict('records')
+    table.pagination = {**pagination, 'rowsNumber': len(df)}
 
 async def run_analysis():
+    """Runs the analysis, rejecting new runs while one is still in progress."""
+    if analysis_lock.locked():
+        ui.notify("An analysis is already running.", color='warning')
+        return
+    async with analysis_lock:
+        run_button.disable()
+        try:
+            await _run_analysis()
+        finally:
+            run_button.enable()
+
+async def _run_analysis():
     """The main function to trigger the analysis."""
     if not uploaded_files["peak_list"] or not uploaded_files["psm_data"]:
         ui.notify("Please upload both peak list and PSM data files.", color='negative')
@@ -58,31 +135,35 @@ async def run_analysis():
         # Give the UI a moment to update before starting the heavy work
         await asyncio.sleep(0.1)
 
-        # Reset file stream pointers to the beginning
-        uploaded_files["peak_list"].seek(0)
-        uploaded_files["psm_data"].seek(0)
-
         # Parse charge states from string input "1, 2, 3" to list [1, 2, 3]
         charge_states_list = [int(c.strip()) for c in charge_states_input.value.split(',')]
         
-        # Assign the UI log to the fingerprinter instance
-        fingerprinter.set_logger(log)
+        # Assign the UI log to the fingerprinter instance. Messages from the
+        # worker thread are handed back to the event loop before reaching it.
+        fingerprinter.set_logger(LoopLogger(log, asyncio.get_running_loop()))
         
-        # These parts are fast, so they can run directly
-        fingerprinter.load_data_from_stream(
-            peak_file_stream=uploaded_files["peak_list"],
-            psm_file_stream=uploaded_files["psm_data"],
-            psm_file_name=uploaded_files["psm_name"]
-        )
+        # Only re-parse the files after a new upload, so re-runs with changed
+        # parameters reuse the loaded data and the fingerprinter's caches.
+        if not uploaded_files["loaded"]:
+            # Reset file stream pointers to the beginning
+            uploaded_files["peak_list"].seek(0)
+            uploaded_files["psm_data"].seek(0)
+            fingerprinter.load_data_from_stream(
+                peak_file_stream=uploaded_files["peak_list"],
+                psm_file_stream=uploaded_files["psm_data"],
+                psm_file_name=uploaded_files["psm_name"]
+            )
+            uploaded_files["loaded"] = True
         fingerprinter.set_parameters(
             ppm_tolerance=ppm_input.value,
             hyperscore_threshold=hyperscore_input.value,
             charge_states=charge_states_list
         )
         
-        # The analysis is still run here, but the `await asyncio.sleep(0.1)`
-        # gives the browser time to render the spinner before this blocks.
-        results_df = fingerprinter.perform_fingerprinting()
+        # Run the matching in a worker thread so the event loop keeps serving
+        # the spinner and log updates. A thread (not a process) keeps the
+        # fingerprinter's caches and UI logger shared with this process.
+        results_df = await run.io_bound(fingerprinter.perform_fingerprinting)
 
         # Display results table
         if not results_df.empty:
@@ -119,14 +200,21 @@ async def run_analysis():
             # Rename the columns for display
             display_df = display_df.rename(columns=column_mapping)
 
+            # Built once per results frame so each page or sort request only runs one search
+            search_text = build_search_text(display_df)
+
             # Create the table definition for niceGUI
             cols = [{'name': col, 'label': col, 'field': col, 'sortable': True} for col in display_df.columns]
             
             with results_table:
                 # The row_key must match a column name *after* renaming
                 row_key = 'Peptide with Modifications' if 'Peptide with Modifications' in display_df.columns else 'Peptide'
-                table = ui.table(columns=cols, rows=display_df.to_dict('records'), row_key=row_key, pagination=25).classes('w-full')
+                # Server-side pagination: only the current page is sent to the browser
+                pagination = {'rowsPerPage': 25, 'page': 1, 'sortBy': None, 'descending': False, 'rowsNumber': len(display_df)}
+                table = ui.table(columns=cols, rows=[], row_key=row_key, pagination=pagination).classes('w-full')
                 table.bind_filter_from(filter_input, 'value')
+                table.on('request', lambda e, df=display_df, text=search_text, t=table: update_table_page(t, df, text, e.args))
+                update_table_page(table, display_df, search_text, {'pagination': pagination, 'filter': None})
             
             download_button.visible = True
             filter_input.visible = True
@@ -135,29 +223,19 @@ async def run_analysis():
         analysis_status.text = 'Generating visualizations...'
         log.push("Generating visualizations...")
         
-        with plot_area_1:
-            fig = fingerprinter.plot_mass_error_distribution()
-            buf = BytesIO()
-            fig.savefig(buf, format='png', bbox_inches='tight')
-            plt.close(fig)
-            b64_str = base64.b64encode(buf.getvalue()).decode('utf-8')
-            ui.image(f'data:image/png;base64,{b64_str}')
-
-        with plot_area_2:
-            fig = fingerprinter.plot_hyperscore_vs_mass_error()
-            buf = BytesIO()
-            fig.savefig(buf, format='png', bbox_inches='tight')
-            plt.close(fig)
-            b64_str = base64.b64encode(buf.getvalue()).decode('utf-8')
-            ui.image(f'data:image/png;base64,{b64_str}')
-
-        with plot_area_3:
-            fig = fingerprinter.plot_hits_per_mass_bin()
-            buf = BytesIO()
-            fig.savefig(buf, format='png', bbox_inches='tight')
-            plt.close(fig)
-            b64_str = base64.b64encode(buf.getvalue()).decode('utf-8')
-            ui.image(f'data:image/png;base64,{b64_str}')
+        # Render the three figures concurrently in worker threads
+        pngs = await asyncio.gather(
+            asyncio.to_thread(fingerprinter.plot_mass_error_distribution_png),
+            asyncio.to_thread(fingerprinter.plot_hyperscore_vs_mass_error_png),
+            asyncio.to_thread(fingerprinter.plot_hits_per_mass_bin_png),
+        )
+        plot_pngs["images"] = list(pngs)
+        plot_pngs["version"] += 1
+
+        # The browser fetches each image from /plot/{i} instead of a base64 data URI
+        for i, plot_area in enumerate([plot_area_1, plot_area_2, plot_area_3]):
+            with plot_area:
+                ui.image(f'/plot/{i}?v={plot_pngs["version"]}')
 
         log.push("Done.")
         analysis_status.text = 'Analysis complete. Please check results below.'
@@ -178,7 +256,7 @@ def main_page():
     """Defines the UI layout and elements."""
     global peak_upload_label, psm_upload_label, ppm_input, hyperscore_input, charge_states_input
     global results_table, download_button, plot_area_1, plot_area_2, plot_area_3, log, filter_input
-    global analysis_spinner, analysis_status
+    global analysis_spinner, analysis_status, run_button
     
     ui.add_head_html('<style>body {background-color: #f4f4f8;}</style>')
     
@@ -203,7 +281,7 @@ def main_page():
 
     with ui.card().classes('w-full max-w-4xl mx-auto mt-6'):
         with ui.row().classes('items-center gap-4'):
-            ui.button('Run Analysis', on_click=run_analysis, icon='science').props('color=primary size=lg')
+            run_button = ui.button('Run Analysis', on_click=run_analysis, icon='science').props('color=primary size=lg')
             analysis_spinner = ui.spinner('primary', size='lg')
             analysis_status = ui.label()
         analysis_spinner.visible = False
@@ -216,7 +294,7 @@ def main_page():
     with ui.card().classes('w-full max-w-4xl mx-auto mt-6'):
         with ui.row().classes('w-full justify-between items-center'):
             ui.label('3. Results').classes('text-xl font-semibold')
-            download_button = ui.button('Download CSV', on_click=lambda: ui.download(get_csv(), 'fingerprinting_results.csv'), icon='download').props('color=secondary')
+            download_button = ui.button('Download CSV', on_click=lambda: ui.download('/download.csv', 'fingerprinting_results.csv'), icon='download').props('color=secondary')
             download_button.visible = False
         
         filter_input = ui.input(placeholder='Search results...').props('dense clearable').classes('w-full mb-2')
@@ -230,10 +308,26 @@ def main_page():
         plot_area_2 = ui.column().classes('w-full border rounded p-2 mt-4')
         plot_area_3 = ui.column().classes('w-full border rounded p-2 mt-4')
 
-def get_csv():
-    """Function to generate the CSV content for download."""
+@app.get('/plot/{i}')
+def get_plot(i: int):
+    """Serves the PNG bytes of one of the latest plots."""
+    if not 0 <= i < len(plot_pngs["images"]):
+        raise HTTPException(status_code=404, detail='Plot not found')
+    return Response(content=plot_pngs["images"][i], media_type='image/png')
+
+@app.get('/download.csv')
+def download_csv():
+    """Streams the results as CSV in chunks instead of building it in memory."""
     df_to_download = fingerprinter.get_results().reset_index()
-    return df_to_download.to_csv(index=False).encode()
+    chunk_size = 10000
+
+    def generate():
+        for i in range(0, max(len(df_to_download), 1), chunk_size):
+            chunk = StringIO()
+            df_to_download.iloc[i:i + chunk_size].to_csv(chunk, index=False, header=(i == 0))
+            yield chunk.getvalue()
+
+    return StreamingResponse(generate(), media_type='text/csv')
 
 # Run the app
 ui.run(host='0.0.0.0')
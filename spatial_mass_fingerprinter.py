@@ -1,10 +1,96 @@
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use('Agg') # Plots are rendered to PNG only; no GUI backend needed
+from matplotlib.figure import Figure
 import seaborn as sns
 import numpy as np
 import os
+from io import BytesIO
 from typing import List, IO
-from io import StringIO
+from pyarrow import csv as pacsv
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+def _join_numpy(sorted_masses, order, mz, ppm):
+    """Matches peaks to sorted PSM masses within a ppm window using NumPy.
+
+    Returns parallel arrays of (peak index, PSM row position) pairs.
+    """
+    tol = mz * (ppm / 1e6)
+    lo = np.searchsorted(sorted_masses, mz - tol, 'left')
+    hi = np.searchsorted(sorted_masses, mz + tol, 'right')
+    # searchsorted places a NaN m/z at the NaN masses sorted last; a blank
+    # peak must match nothing, as in the compiled kernel.
+    counts = np.where(np.isnan(mz), 0, hi - lo)
+    total_matches = int(counts.sum())
+
+    # Expand each [lo, hi) window into positions of the sorted array
+    # without building a Python list of per-peak slices.
+    starts = np.cumsum(counts) - counts
+    sorted_pos = np.repeat(lo - starts, counts) + np.arange(total_matches)
+    return np.repeat(np.arange(len(mz)), counts), order[sorted_pos]
+
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True, nogil=True)
+    def _join_kernel(sorted_masses, order, mz, ppm):
+        """Compiled equivalent of `_join_numpy`, parallelised over peaks."""
+        n_peaks = mz.shape[0]
+        n_masses = sorted_masses.shape[0]
+        lo = np.empty(n_peaks, dtype=np.int64)
+        counts = np.empty(n_peaks, dtype=np.int64)
+
+        # Pass 1: binary search both window edges to count matches per peak.
+        for i in prange(n_peaks):
+            tol = mz[i] * (ppm / 1e6)
+            lower, upper = mz[i] - tol, mz[i] + tol
+            a, b = 0, n_masses
+            while a < b:
+                m = (a + b) // 2
+                if sorted_masses[m] < lower:
+                    a = m + 1
+                else:
+                    b = m
+            start = a
+            b = n_masses
+            while a < b:
+                m = (a + b) // 2
+                if sorted_masses[m] <= upper:
+                    a = m + 1
+                else:
+                    b = m
+            lo[i] = start
+            counts[i] = a - start
+
+        offsets = np.cumsum(counts)
+        total_matches = offsets[-1] if n_peaks > 0 else 0
+        out_peak = np.empty(total_matches, dtype=np.int64)
+        out_psm = np.empty(total_matches, dtype=np.int64)
+
+        # Pass 2: fill each peak's slice of the preallocated output buffers.
+        for i in prange(n_peaks):
+            begin = offsets[i] - counts[i]
+            for k in range(counts[i]):
+                out_peak[begin + k] = i
+                out_psm[begin + k] = order[lo[i] + k]
+        return out_peak, out_psm
+else:
+    _join_kernel = _join_numpy
+
+# PSM columns carried through filtering and matching; all others are dropped.
+KEEP_COLUMNS = [
+    'Calibrated Observed Mass', 'Hyperscore', 'Charge', 'Protein Description', 'Gene',
+    'Modified Peptide', 'Peptide', 'Ion Mobility', 'Retention', 'Calculated M/Z', 'Nextscore',
+]
+
+# Highly repetitive text columns in PSM tables, stored as pandas categoricals.
+CATEGORICAL_COLUMNS = ['Gene', 'Protein Description', 'Modified Peptide', 'Peptide']
+
 
 class SpatialMassFingerprinter:
     """
@@ -21,8 +107,16 @@ class SpatialMassFingerprinter:
         self.results_df = pd.DataFrame()
         self.ppm_tolerance = 10
         self.hyperscore_threshold = 18.0
-        self.charge_states = [1]
+        self.charge_states = np.array([1], dtype=np.int8)
         self.logger = None # Placeholder for a logger object
+        self._filter_cache = {} # Last filtered PSM frame, keyed by its filter parameters
+        self._filter_key = None
+        self._sort_cache = {} # Last (sorted masses, sort order), keyed by filter key and mass column
+        self._sorted_masses = None
+        self._sort_order = None
+        self._plot_cache = {} # Rendered PNG bytes keyed by plot, results identity and parameters
+        self._mass_err_hist = None # (bins, (counts, edges)) for the current results
+        self._mass_bin_hist = None # (bin_width, (counts, edges)) for the current results
 
     def set_logger(self, logger):
         """Assigns a logger object to stream messages to the UI."""
@@ -35,11 +129,26 @@ class SpatialMassFingerprinter:
         else:
             print(message) # Fallback to console print
 
+    @staticmethod
+    def _downcast_numeric_columns(df: pd.DataFrame) -> pd.DataFrame:
+        """(Private) Downcasts integer columns (e.g. Charge) to the smallest int dtype.
+
+        Float columns stay float64: masses feed the ppm matching, and scores,
+        retention and ion mobility are displayed and exported, where float32
+        rounding would show up as changed values.
+        """
+        for col in df.select_dtypes(include=['integer']).columns:
+            df[col] = pd.to_numeric(df[col], downcast='integer')
+        return df
+
     def load_data_from_stream(self, peak_file_stream: IO, psm_file_stream: IO, psm_file_name: str):
         """Loads data from in-memory file streams."""
         try:
             self._log("Loading peak list...")
-            self.peak_df = pd.read_csv(peak_file_stream)
+            # Empty text fields become NaN, matching pandas' read_csv behaviour.
+            convert_options = pacsv.ConvertOptions(strings_can_be_null=True)
+            self.peak_df = pacsv.read_csv(peak_file_stream, convert_options=convert_options).to_pandas()
+            self.peak_df = self._downcast_numeric_columns(self.peak_df)
             self._log(f"-> Successfully loaded peak list. Shape: {self.peak_df.shape}")
 
             self._log("Loading PSM data...")
@@ -47,9 +156,22 @@ class SpatialMassFingerprinter:
             separator = '\t' if psm_ext.lower() in ['.tsv', '.txt'] else ','
             self._log(f"-> Detected '{psm_ext}' extension, using '{separator}' as separator.")
             
-            psm_content = psm_file_stream.read().decode('utf-8')
-            self.psm_df = pd.read_csv(StringIO(psm_content), sep=separator)
+            self.psm_df = pacsv.read_csv(
+                psm_file_stream,
+                parse_options=pacsv.ParseOptions(delimiter=separator),
+                convert_options=convert_options,
+            ).to_pandas()
+            self.psm_df = self._downcast_numeric_columns(self.psm_df)
+            # Blank charges load as NaN floats; those rows are simply dropped by
+            # the np.isin filter, so only cast when every charge is present.
+            if 'Charge' in self.psm_df.columns and self.psm_df['Charge'].notna().all():
+                self.psm_df['Charge'] = self.psm_df['Charge'].astype('int8')
+            for col in CATEGORICAL_COLUMNS:
+                if col in self.psm_df.columns:
+                    self.psm_df[col] = self.psm_df[col].astype('category')
             self._log(f"-> Successfully loaded PSM data. Shape: {self.psm_df.shape}")
+            self._filter_cache = {}
+            self._sort_cache = {}
             
             return True
         except Exception as e:
@@ -60,107 +182,202 @@ class SpatialMassFingerprinter:
         """Sets the analysis parameters."""
         self.ppm_tolerance = ppm_tolerance
         self.hyperscore_threshold = hyperscore_threshold
-        self.charge_states = charge_states
+        # Deduplicated, sorted int8 array: matches the Charge dtype for np.isin
+        # and hashes consistently for the filter cache key.
+        self.charge_states = np.asarray(sorted(set(charge_states)), dtype=np.int8)
         self._log("Parameters updated:")
         self._log(f"  - PPM Tolerance: {self.ppm_tolerance}")
         self._log(f"  - Hyperscore Threshold: {self.hyperscore_threshold}")
-        self._log(f"  - Charge States: {self.charge_states}")
+        self._log(f"  - Charge States: {self.charge_states.tolist()}")
+
+    def _filter_psms(self, psm_df: pd.DataFrame, hyperscore_threshold: float, charge_states: np.ndarray,
+                     psm_column_to_use: str = 'Calibrated Observed Mass'):
+        """(Private) Filters PSMs based on set criteria and drops unused columns.
 
-    def _filter_psms(self):
-        """(Private) Filters PSMs based on set criteria."""
-        if self.psm_df is None: return
+        Returns the filtered frame and the cache key it is stored under.
+        """
         self._log("Filtering PSMs...")
-        initial_count = len(self.psm_df)
-        
-        self.filtered_psm_df = self.psm_df[
-            (self.psm_df['Hyperscore'] > self.hyperscore_threshold) &
-            (self.psm_df['Charge'].isin(self.charge_states))
-        ].copy()
+        initial_count = len(psm_df)
+
+        # Reuse the previous result when only non-filter parameters (e.g. PPM) changed.
+        cache_key = (id(psm_df), hyperscore_threshold, tuple(charge_states.tolist()), psm_column_to_use)
+        filter_cache = self._filter_cache
+        if cache_key in filter_cache:
+            self._log("-> Reusing cached PSM filter results.")
+            filtered_psm_df = filter_cache[cache_key]
+        else:
+            charges = psm_df['Charge'].to_numpy()
+            mask = (
+                np.isin(charges, charge_states) &
+                (psm_df['Hyperscore'].to_numpy() > hyperscore_threshold)
+            )
+            keep = [col for col in psm_df.columns if col in KEEP_COLUMNS or col == psm_column_to_use]
+            filtered_psm_df = psm_df.iloc[mask][keep]
+            # Keep only the latest entry so sweeping the threshold doesn't pile up copies
+            self._filter_cache = {cache_key: filtered_psm_df}
         
-        filtered_count = len(self.filtered_psm_df)
         self._log(f"-> Initial PSM count: {initial_count}")
-        self._log(f"-> PSMs after filtering: {filtered_count}")
+        self._log(f"-> PSMs after filtering: {len(filtered_psm_df)}")
+        return filtered_psm_df, cache_key
+
+    def _sort_psm_masses(self, filtered_psm_df: pd.DataFrame, filter_key: tuple, psm_column_to_use: str):
+        """(Private) Sorts the filtered PSM masses once per filter result and mass column.
+
+        Returns the sorted masses and the argsort order into `filtered_psm_df`.
+        """
+        cache_key = (filter_key, psm_column_to_use)
+        sort_cache = self._sort_cache
+        if cache_key in sort_cache:
+            return sort_cache[cache_key]
+        masses = filtered_psm_df[psm_column_to_use].to_numpy(dtype=np.float64)
+        order = np.argsort(masses, kind='stable')
+        entry = (masses[order], order)
+        self._sort_cache = {cache_key: entry}
+        return entry
 
     def perform_fingerprinting(self, psm_column_to_use: str = 'Calibrated Observed Mass'):
         """Performs the core peak-to-peptide matching."""
-        if self.peak_df is None or self.psm_df is None:
+        peak_df, psm_df = self.peak_df, self.psm_df
+        if peak_df is None or psm_df is None:
             self._log("ERROR: Data not loaded. Cannot perform fingerprinting.")
             return pd.DataFrame()
 
         self._log("\nStarting mass fingerprinting...")
-        self._filter_psms()
+        # Work on a snapshot of the inputs and parameters and only publish the
+        # results to the instance at the end, so a concurrent call to
+        # set_parameters or load_data_from_stream can't mix state mid-run.
+        ppm_tolerance = float(self.ppm_tolerance)
+        filtered_psm_df, filter_key = self._filter_psms(
+            psm_df, self.hyperscore_threshold, self.charge_states, psm_column_to_use
+        )
+        sorted_masses, sort_order = None, None
 
-        if self.filtered_psm_df is None or self.filtered_psm_df.empty:
+        if filtered_psm_df.empty:
             self._log("Warning: No PSMs remained after filtering. Cannot perform matching.")
-            self.results_df = pd.DataFrame()
-            return self.results_df
-
-        self._log("Matching peaks to filtered peptides...")
-        all_matches = []
-        total_peaks = len(self.peak_df)
-        for i, (_, peak_row) in enumerate(self.peak_df.iterrows()):
-            if (i + 1) % 100 == 0:
-                self._log(f"  - Processing peak {i+1}/{total_peaks}...")
-            
-            peak_mz = peak_row['m/z']
-            tolerance_da = (self.ppm_tolerance / 1e6) * peak_mz
-            mass_lower_bound, mass_upper_bound = peak_mz - tolerance_da, peak_mz + tolerance_da
-            
-            matches_df = self.filtered_psm_df[
-                self.filtered_psm_df[psm_column_to_use].between(mass_lower_bound, mass_upper_bound)
-            ].copy()
+            results_df = pd.DataFrame()
+        else:
+            self._log("Matching peaks to filtered peptides...")
+            total_peaks = len(peak_df)
+            self._log(f"  - Processing {total_peaks} peaks...")
 
-            if not matches_df.empty:
-                matches_df['MALDI M/Z Value'] = peak_mz
-                matches_df['Mass Error (ppm)'] = ((matches_df[psm_column_to_use] - peak_mz) / peak_mz) * 1e6
-                all_matches.extend(matches_df.to_dict('records'))
+            # Sort the PSM masses once (reused across runs), then find each peak's
+            # tolerance window with a binary search instead of scanning every PSM.
+            sorted_masses, sort_order = self._sort_psm_masses(filtered_psm_df, filter_key, psm_column_to_use)
+            mz = peak_df['m/z'].to_numpy(dtype=np.float64)
+            match_peak_idx, match_psm_idx = _join_kernel(sorted_masses, sort_order, mz, ppm_tolerance)
 
-        self.results_df = pd.DataFrame(all_matches)
-        if not self.results_df.empty:
-            self.results_df.set_index('MALDI M/Z Value', inplace=True)
+            if len(match_psm_idx) == 0:
+                results_df = pd.DataFrame()
+            else:
+                match_peak_mz = mz[match_peak_idx]
+
+                # A single positional take builds the whole results frame at once.
+                result = filtered_psm_df.iloc[match_psm_idx].reset_index(drop=True)
+                result['MALDI M/Z Value'] = match_peak_mz
+                # One division per peak instead of per match: scale by 1e6 / m/z.
+                ppm_scale = (1e6 / mz)[match_peak_idx]
+                result['Mass Error (ppm)'] = (result[psm_column_to_use].to_numpy() - match_peak_mz) * ppm_scale
+                results_df = result.set_index('MALDI M/Z Value')
+
+        self.filtered_psm_df = filtered_psm_df
+        self._filter_key = filter_key
+        self._sorted_masses, self._sort_order = sorted_masses, sort_order
+        self.results_df = results_df
+        self._plot_cache.clear()
+        self._precompute_plot_data()
         
-        self._log(f"Fingerprinting complete. Found {len(self.results_df)} total matches.")
-        return self.results_df
+        self._log(f"Fingerprinting complete. Found {len(results_df)} total matches.")
+        return results_df
     
+    def _precompute_plot_data(self, bins: int = 50, bin_width: int = 10):
+        """(Private) Computes the histograms for the default plot parameters once per result."""
+        self._mass_err_hist = None
+        self._mass_bin_hist = None
+        if self.results_df.empty: return
+        self._mass_err_hist = (bins, self._mass_error_histogram(bins))
+        self._mass_bin_hist = (bin_width, self._mass_bin_histogram(bin_width))
+
+    def _mass_error_histogram(self, bins: int):
+        """(Private) Returns (counts, edges) of the mass error distribution."""
+        if self._mass_err_hist is not None and self._mass_err_hist[0] == bins:
+            return self._mass_err_hist[1]
+        return np.histogram(self.results_df['Mass Error (ppm)'].to_numpy(), bins=bins)
+
+    def _mass_bin_histogram(self, bin_width: int):
+        """(Private) Returns (counts, edges) of matched peptides per m/z bin."""
+        if self._mass_bin_hist is not None and self._mass_bin_hist[0] == bin_width:
+            return self._mass_bin_hist[1]
+        mass_values = self.results_df.index.to_numpy()
+        min_mass = int(mass_values.min() // bin_width * bin_width)
+        max_mass = int(mass_values.max() // bin_width * bin_width) + bin_width
+        bins = np.arange(min_mass, max_mass + bin_width, bin_width)
+        return np.histogram(mass_values, bins=bins)
+
     def get_results(self) -> pd.DataFrame:
         """Returns the results dataframe."""
         return self.results_df
 
-    def plot_mass_error_distribution(self, bins: int = 50):
+    def plot_mass_error_distribution(self, bins: int = 50, kde: bool = False):
         """Generates a histogram of mass error distribution."""
-        fig, ax = plt.subplots(figsize=(10, 6))
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
         if not self.results_df.empty:
-            sns.histplot(self.results_df['Mass Error (ppm)'], bins=bins, kde=True, ax=ax)
+            if kde:
+                sns.histplot(self.results_df['Mass Error (ppm)'], bins=bins, kde=True, ax=ax)
+            else:
+                counts, edges = self._mass_error_histogram(bins)
+                ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge', edgecolor='white')
             ax.axvline(0, color='red', linestyle='--', linewidth=1.5)
         ax.set_title('Mass Error Distribution', fontsize=16)
         ax.set_xlabel('Mass Error (ppm)', fontsize=12)
         ax.set_ylabel('Frequency', fontsize=12)
-        plt.tight_layout()
+        fig.tight_layout()
         return fig
 
     def plot_hyperscore_vs_mass_error(self):
         """Generates a scatter plot of Hyperscore vs. Mass Error."""
-        fig, ax = plt.subplots(figsize=(10, 6))
+        fig = Figure(figsize=(10, 6))
+        ax = fig.subplots()
         if not self.results_df.empty:
-            sns.scatterplot(data=self.results_df, x='Mass Error (ppm)', y='Hyperscore', alpha=0.7, ax=ax)
+            ax.scatter(self.results_df['Mass Error (ppm)'], self.results_df['Hyperscore'], s=8, alpha=0.5, rasterized=True)
         ax.set_title('Hyperscore vs. Mass Error', fontsize=16)
         ax.set_xlabel('Mass Error (ppm)', fontsize=12)
         ax.set_ylabel('Hyperscore', fontsize=12)
-        plt.tight_layout()
+        fig.tight_layout()
         return fig
 
     def plot_hits_per_mass_bin(self, bin_width: int = 10):
         """Generates a histogram of peptide hits per mass bin."""
-        fig, ax = plt.subplots(figsize=(12, 7))
+        fig = Figure(figsize=(12, 7))
+        ax = fig.subplots()
         if not self.results_df.empty:
-            mass_values = self.results_df.index
-            min_mass = int(mass_values.min() // bin_width * bin_width)
-            max_mass = int(mass_values.max() // bin_width * bin_width) + bin_width
-            bins = np.arange(min_mass, max_mass + bin_width, bin_width)
-            sns.histplot(x=mass_values, bins=bins, ax=ax)
+            counts, edges = self._mass_bin_histogram(bin_width)
+            ax.bar(edges[:-1], counts, width=np.diff(edges), align='edge', edgecolor='white')
         ax.set_title(f'Peptide Identifications per {bin_width} Da Bin', fontsize=16)
         ax.set_xlabel('m/z', fontsize=12)
         ax.set_ylabel('Number of Matched Peptides', fontsize=12)
-        plt.xticks(rotation=45)
-        plt.tight_layout()
+        ax.tick_params(axis='x', labelrotation=45)
+        fig.tight_layout()
         return fig
+
+    def _cached_png(self, plot_func, *args) -> bytes:
+        """(Private) Renders a plot to PNG bytes, reusing the cached image for the current results."""
+        key = (plot_func.__name__, id(self.results_df)) + args
+        if key not in self._plot_cache:
+            fig = plot_func(*args)
+            buf = BytesIO()
+            fig.savefig(buf, format='png', bbox_inches='tight')
+            self._plot_cache[key] = buf.getvalue()
+        return self._plot_cache[key]
+
+    def plot_mass_error_distribution_png(self, bins: int = 50) -> bytes:
+        """Returns the mass error distribution plot as PNG bytes."""
+        return self._cached_png(self.plot_mass_error_distribution, bins)
+
+    def plot_hyperscore_vs_mass_error_png(self) -> bytes:
+        """Returns the Hyperscore vs. Mass Error plot as PNG bytes."""
+        return self._cached_png(self.plot_hyperscore_vs_mass_error)
+
+    def plot_hits_per_mass_bin_png(self, bin_width: int = 10) -> bytes:
+        """Returns the hits per mass bin plot as PNG bytes."""
+        return self._cached_png(self.plot_hits_per_mass_bin, bin_width)